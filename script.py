@@ -1,38 +1,104 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
+import functools
 import json
-import subprocess
 import time
 from datetime import datetime, timedelta
 import re
 import logging
+import logging.handlers
 import os
-from typing import Dict, List, Optional
+import shutil
+import signal
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Tuple
 import pytz  # For timezone handling
 
+try:
+    import orjson  # Faster JSON (de)serialization when available
+except ImportError:
+    orjson = None
+
 # Get local timezone
 local_tz = pytz.timezone('Asia/Karachi')  # Pakistan timezone
 
-# Setup logging
+# Termination window format, e.g. "2h", "0.5d"
+_WINDOW_RE = re.compile(r'(\d*\.?\d+)([hd])')
+
+# Line prefixes in `kubectl inspect gpushare -d` output
+_SECTION_END_PREFIXES = ('IPADDRESS:', 'Allocated :', 'Total :', 'Allocated/Total')
+# Lines that end the pod rows of a node; NAME: starts the next node
+_ROWS_END_PREFIXES = _SECTION_END_PREFIXES + ('NAME:',)
+
+# Upper bound on kubectl annotate processes running at once
+_MAX_CONCURRENT_TERMINATIONS = 8
+
+# Seconds a kubectl command may run before it is killed
+_COMMAND_TIMEOUT = 30
+
+class CommandError(Exception):
+    """Raised when a streamed command fails to start, exits non-zero or times out"""
+
+async def _kill_process(process: asyncio.subprocess.Process) -> None:
+    """Kill and reap a child started with start_new_session=True if it is still running"""
+    if process.returncode is None:
+        # Kill the whole process group so no grandchild keeps the pipes open
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+def _dump_json(data: dict) -> bytes:
+    """Serialize data to indented JSON bytes"""
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2).encode('utf-8')
+
+def _load_json(content: bytes):
+    """Deserialize JSON bytes"""
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+# Setup logging; file writes are buffered and flushed per cycle or on ERROR
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+file_handler = logging.FileHandler('resource_manager.log')
+file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+log_file_handler = logging.handlers.MemoryHandler(
+    capacity=256,
+    flushLevel=logging.ERROR,
+    target=file_handler
+)
+atexit.register(log_file_handler.flush)
+
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
+    format=LOG_FORMAT,
     handlers=[
-        logging.FileHandler('resource_manager.log'),
+        log_file_handler,
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
 
+class PodRef(NamedTuple):
+    """GPU pod discovered in kubectl inspect gpushare output"""
+    name: str
+    namespace: str
+    node: Optional[str]
+    full_name: str
+
 class K8sResourceManager:
     def __init__(self, config_file: str = 'pod_config.json'):
         self.config_file = config_file
         self.creation_time_cache = {}
         self.cache_expiry = 300
+        self._kubectl = shutil.which('kubectl') or 'kubectl'
+        self._dirty = False
         self.config = self.load_config()
-
-    def get_local_time(self) -> str:
-        """Get current time in local timezone"""
-        return datetime.now(local_tz).isoformat()
+        self._excluded_ns = set(self.config.get("excluded_namespaces", []))
+        self._config_mtime = self.get_config_mtime()
 
     def format_duration(self, hours: float) -> str:
         """Format duration in hours to human readable string"""
@@ -45,15 +111,30 @@ class K8sResourceManager:
             days = hours / 24
             return f"{days:.1f} days"
 
+    def _write_config(self, data: dict) -> None:
+        """Write data to the config file atomically via a temp file and os.replace"""
+        tmp_file = self.config_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(_dump_json(data))
+        os.replace(tmp_file, self.config_file)
+
     def save_config(self) -> None:
-        """Save current configuration to JSON file"""
+        """Save current configuration to JSON file atomically"""
         try:
-            with open(self.config_file, 'w') as f:
-                json.dump(self.config, f, indent=2)
+            self._write_config(self.config)
+            self._dirty = False
+            self._config_mtime = self.get_config_mtime()
             logger.debug("Configuration saved successfully")
         except Exception as e:
             logger.error(f"Error saving config file: {str(e)}")
 
+    def get_config_mtime(self) -> Optional[int]:
+        """Get config file modification time in nanoseconds, None if missing"""
+        try:
+            return os.stat(self.config_file).st_mtime_ns
+        except OSError:
+            return None
+
     def load_config(self) -> dict:
         """Load configuration from JSON file with error handling"""
         default_config = {
@@ -65,24 +146,24 @@ class K8sResourceManager:
 
         try:
             if not os.path.exists(self.config_file):
-                with open(self.config_file, 'w') as f:
-                    json.dump(default_config, f, indent=2)
+                self._write_config(default_config)
                 logger.info("Created default config file")
                 return default_config
 
-            with open(self.config_file, 'r') as f:
+            with open(self.config_file, 'rb') as f:
                 content = f.read().strip()
                 if not content:
-                    with open(self.config_file, 'w') as f:
-                        json.dump(default_config, f, indent=2)
+                    self._write_config(default_config)
                     return default_config
                     
                 try:
-                    config = json.loads(content)
+                    config = _load_json(content)
                     if "pod_timestamps" not in config:
                         config["pod_timestamps"] = {}
                     if "namespaces" not in config:
                         config["namespaces"] = {}
+                    if self.migrate_pod_timestamps(config):
+                        self._dirty = True
                     return config
                 except json.JSONDecodeError as e:
                     logger.error(f"Invalid JSON in config file: {str(e)}")
@@ -94,105 +175,180 @@ class K8sResourceManager:
             logger.info("Using default configuration")
             return default_config
 
-    def update_pod_timestamp(self, namespace: str, pod_name: str) -> None:
-        """Update pod's last seen running timestamp only if new or previously stopped"""
-        if "pod_timestamps" not in self.config:
-            self.config["pod_timestamps"] = {}
-            
-        if namespace not in self.config["pod_timestamps"]:
-            self.config["pod_timestamps"][namespace] = {}
-            
-        current_time = self.get_local_time()
-        
-        # Update timestamp only if:
-        # 1. Pod is not in our records
-        # 2. Pod was previously stopped
-        pod_info = self.config["pod_timestamps"][namespace].get(pod_name, {})
-        if not pod_info or "last_stopped" in pod_info:
-            self.config["pod_timestamps"][namespace][pod_name] = {
-                "last_seen_running": current_time
-            }
-            logger.info(f"Updated start time for pod {pod_name} in namespace {namespace}")
-            self.save_config()
-
-    def execute_command(self, command: List[str]) -> Optional[str]:
+    def migrate_pod_timestamps(self, config: dict) -> bool:
+        """Convert legacy ISO "last_seen_running" entries to epoch seconds"""
+        migrated = False
+        for namespace_pods in config["pod_timestamps"].values():
+            for pod_info in namespace_pods.values():
+                if "last_seen_running" not in pod_info:
+                    continue
+                try:
+                    start_time = datetime.fromisoformat(pod_info["last_seen_running"])
+                    pod_info["last_seen_running_epoch"] = start_time.timestamp()
+                    del pod_info["last_seen_running"]
+                    migrated = True
+                except (TypeError, ValueError) as e:
+                    logger.error(f"Invalid legacy timestamp in config: {e}")
+        if migrated:
+            logger.info("Migrated legacy pod timestamps to epoch seconds")
+        return migrated
+
+    def update_pod_timestamps(self, seen_pods: List[Tuple[str, str]]) -> None:
+        """Update last seen running timestamps for pods that are new or previously stopped"""
+        pod_timestamps = self.config.setdefault("pod_timestamps", {})
+        now_epoch = time.time()
+        updated = 0
+
+        for namespace, pod_name in seen_pods:
+            namespace_pods = pod_timestamps.setdefault(namespace, {})
+
+            # Update timestamp only if:
+            # 1. Pod is not in our records
+            # 2. Pod was previously stopped
+            pod_info = namespace_pods.get(pod_name)
+            if not pod_info or "last_stopped" in pod_info:
+                namespace_pods[pod_name] = {
+                    "last_seen_running_epoch": now_epoch
+                }
+                updated += 1
+
+        if updated:
+            logger.info(f"Updated start time for {updated} pod(s)")
+            self._dirty = True
+
+    async def execute_command(self, command: List[str]) -> Optional[str]:
         """Execute command with timeout"""
         try:
-            process = subprocess.run(
-                command,
-                capture_output=True,
-                text=True,
-                timeout=30
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
             )
-
-            if process.returncode == 0:
-                return process.stdout
-            logger.error(f"Command failed: {process.stderr}")
-            return None
-        except Exception as e:
+        except OSError as e:
             logger.error(f"Command error: {e}")
             return None
 
-    def parse_gpushare_output(self) -> List[dict]:
-        """Parse kubectl inspect gpushare output"""
-        logger.info("Fetching GPU allocations...")
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), _COMMAND_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"Command timed out: {' '.join(command)}")
+            return None
+        finally:
+            # Also runs on cancellation, so the child is reaped before the loop closes
+            await _kill_process(process)
 
-        output = self.execute_command(['kubectl', 'inspect', 'gpushare', '-d'])
-        if not output:
-            return []
+        if process.returncode == 0:
+            return stdout.decode()
+        logger.error(f"Command failed: {stderr.decode()}")
+        return None
 
-        pods = []
-        current_node = None
-        reading_pod_section = False
+    async def execute_command_stream(self, command: List[str]) -> AsyncIterator[str]:
+        """Execute command and yield stdout lines as they arrive, raising CommandError on failure"""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *command,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                start_new_session=True
+            )
+        except OSError as e:
+            raise CommandError(f"Command error: {e}")
 
-        for line in output.strip().split('\n'):
-            line = line.strip()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + _COMMAND_TIMEOUT
+        # Drain stderr concurrently so a chatty command cannot fill the pipe and block
+        stderr_task = asyncio.ensure_future(process.stderr.read())
 
-            if not line or line.startswith('---'):
-                continue
+        try:
+            while True:
+                line = await asyncio.wait_for(process.stdout.readline(), max(deadline - loop.time(), 0))
+                if not line:
+                    break
+                yield line.decode()
+
+            await asyncio.wait_for(process.wait(), max(deadline - loop.time(), 0))
+            stderr = await stderr_task
+        except asyncio.TimeoutError:
+            raise CommandError(f"Command timed out: {' '.join(command)}")
+        finally:
+            # Also runs on cancellation, so the child is reaped before the loop closes
+            await _kill_process(process)
+            stderr_task.cancel()
+
+        if process.returncode != 0:
+            raise CommandError(f"Command failed: {stderr.decode()}")
+
+    async def parse_gpushare_output(self) -> Tuple[List[PodRef], List[Tuple[str, str]]]:
+        """Parse kubectl inspect gpushare output, returning pods and (namespace, name) pairs seen"""
+        logger.info("Fetching GPU allocations...")
 
+        pods = []
+        seen_pods = []
+        current_node = None
+
+        # Two-state parser: node header lines until the pod table header is
+        # seen, then pod rows until a section-ending line
+        def _handle_header(line: str) -> None:
+            nonlocal current_node, handle_line
             if line.startswith('NAME:'):
                 current_node = line.split()[1].strip()
-                reading_pod_section = False
-                continue
-
-            if 'NAMESPACE' in line and 'GPU0(Allocated)' in line:
-                reading_pod_section = True
-                continue
-
-            if any(line.startswith(x) for x in ['IPADDRESS:', 'Allocated :', 'Total :', 'Allocated/Total']):
-                reading_pod_section = False
-                continue
-
-            if reading_pod_section and line:
-                parts = line.split()
-                if len(parts) >= 2 and not line.startswith(('NAME:', 'IPADDRESS:', 'Allocated :', 'Total :')):
-                    pod_name = parts[0]
-                    namespace = parts[1]
-
-                    if namespace in self.config.get("excluded_namespaces", []):
-                        logger.debug(f"Skipping pod in excluded namespace: {namespace}/{pod_name}")
-                        continue
-
-                    # Update timestamp when we see a running pod
-                    self.update_pod_timestamp(namespace, pod_name)
-
-                    pod_info = {
-                        'name': pod_name,
-                        'namespace': namespace,
-                        'node': current_node,
-                        'full_name': pod_name
-                    }
-                    pods.append(pod_info)
-                    logger.info(f"\nFound pod: {pod_name}")
-                    logger.info(f"  Namespace: {namespace}")
-                    logger.info(f"  Node: {current_node}")
-
-        found_pods = len(pods)
-        logger.info(f"\nTotal pods found: {found_pods}")
-        return pods
-
-    def parse_notebook_name(self, name: str) -> str:
+            elif 'NAMESPACE' in line and 'GPU0(Allocated)' in line:
+                handle_line = _handle_rows
+
+        def _handle_rows(line: str) -> None:
+            nonlocal handle_line
+            if line.startswith(_ROWS_END_PREFIXES):
+                handle_line = _handle_header
+                _handle_header(line)
+                return
+
+            parts = line.split()
+            if len(parts) < 2 or parts[1] == 'NAMESPACE':
+                return
+
+            pod_name = parts[0]
+            namespace = parts[1]
+
+            if namespace in self._excluded_ns:
+                logger.debug(f"Skipping pod in excluded namespace: {namespace}/{pod_name}")
+                return
+
+            # Record running pod; timestamps are updated in bulk after parsing
+            seen_pods.append((namespace, pod_name))
+
+            pods.append(PodRef(
+                name=pod_name,
+                namespace=namespace,
+                node=current_node,
+                full_name=pod_name
+            ))
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"\nFound pod: {pod_name}")
+                logger.debug(f"  Namespace: {namespace}")
+                logger.debug(f"  Node: {current_node}")
+
+        handle_line = _handle_header
+
+        try:
+            async for line in self.execute_command_stream([self._kubectl, 'inspect', 'gpushare', '-d']):
+                line = line.strip()
+
+                if not line or line.startswith('---'):
+                    continue
+
+                handle_line(line)
+        except CommandError as e:
+            # Output from a failed or partial run is not trusted
+            logger.error(str(e))
+            return [], []
+
+        logger.info("Found %d pods: %s", len(pods), [(p.namespace, p.name) for p in pods])
+        return pods, seen_pods
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1024)
+    def parse_notebook_name(name: str) -> str:
         """Parse notebook name by removing numerical suffixes while preserving alphabetical parts."""
         parts = name.split('-')
         result_parts = []
@@ -206,49 +362,37 @@ class K8sResourceManager:
         
         return '-'.join(result_parts)
 
-    def calculate_pod_age(self, start_time_str: str) -> float:
-        """Calculate pod age in hours"""
-        try:
-            start_time = datetime.fromisoformat(start_time_str)
-            current_time = datetime.now(local_tz)
-            age = current_time - start_time.astimezone(local_tz)
-            return age.total_seconds() / 3600
-        except Exception as e:
-            logger.error(f"Error calculating pod age: {e}")
-            return 0
+    def calculate_pod_age(self, start_epoch: float, now_epoch: float) -> float:
+        """Calculate pod age in hours relative to now_epoch"""
+        return (now_epoch - start_epoch) / 3600.0
 
-    def should_terminate_pod(self, namespace: str, pod_name: str, termination_window: str) -> tuple[bool, float]:
-        """Check if pod should be terminated and return remaining time"""
-        try:
-            if namespace not in self.config["pod_timestamps"]:
-                return False, 0
-                
-            if pod_name not in self.config["pod_timestamps"][namespace]:
-                return False, 0
-                
-            pod_info = self.config["pod_timestamps"][namespace][pod_name]
-            if "last_seen_running" not in pod_info:
-                return False, 0
+    def parse_termination_window(self, termination_window: str) -> Optional[float]:
+        """Parse termination window string (e.g. "2h", "0.5d") into hours"""
+        match = _WINDOW_RE.match(termination_window)
+        if not match:
+            return None
 
-            age_hours = self.calculate_pod_age(pod_info["last_seen_running"])
-            
-            match = re.match(r'(\d*\.?\d+)([hd])', termination_window)
-            if not match:
-                return False, 0
+        value = float(match.group(1))
+        unit = match.group(2)
+
+        return value if unit == 'h' else value * 24
 
-            value = float(match.group(1))
-            unit = match.group(2)
+    def should_terminate_pod(self, pod_info: Optional[dict], limit_hours: float, now_epoch: float) -> tuple[bool, float, Optional[float]]:
+        """Check if pod should be terminated and return remaining time and age (None if untracked)"""
+        try:
+            if not pod_info or "last_seen_running_epoch" not in pod_info:
+                return False, 0, None
 
-            limit_hours = value if unit == 'h' else value * 24
+            age_hours = self.calculate_pod_age(pod_info["last_seen_running_epoch"], now_epoch)
             remaining_hours = limit_hours - age_hours
 
-            return age_hours > limit_hours, remaining_hours
+            return age_hours > limit_hours, remaining_hours, age_hours
 
         except Exception as e:
             logger.error(f"Error checking termination: {e}")
-            return False, 0
+            return False, 0, None
 
-    def terminate_pod(self, namespace: str, name: str, full_name: str) -> bool:
+    async def terminate_pod(self, namespace: str, name: str, full_name: str, current_time: str) -> bool:
         """Terminate a notebook using the annotation method"""
         try:
             base_notebook_name = self.parse_notebook_name(name)
@@ -258,14 +402,12 @@ class K8sResourceManager:
             logger.info(f"  Base name: {base_notebook_name}")
             logger.info(f"  Namespace: {namespace}")
             
-            current_time = self.get_local_time()
-            
             if namespace in self.config["pod_timestamps"] and name in self.config["pod_timestamps"][namespace]:
                 self.config["pod_timestamps"][namespace][name]["last_stopped"] = current_time
-                self.save_config()
+                self._dirty = True
             
-            result = self.execute_command([
-                'kubectl', 'annotate', 'notebook', 
+            result = await self.execute_command([
+                self._kubectl, 'annotate', 'notebook', 
                 base_notebook_name,
                 f'kubeflow-resource-stopped={current_time}',
                 '-n', namespace,
@@ -283,21 +425,35 @@ class K8sResourceManager:
             logger.error(f"Error terminating notebook: {e}")
             return False
 
-    def process_pods(self, pods: List[dict]) -> None:
+    async def process_pods(self, pods: List[PodRef]) -> None:
         """Process all found pods"""
+        termination_window = self.config.get("default_termination_window", "2h")
+        limit_hours = self.parse_termination_window(termination_window)
+        if limit_hours is None:
+            logger.error(f"Invalid termination window in config: {termination_window}")
+            return
+
+        # Single clock read per cycle shared by all pods
+        now = datetime.now(local_tz)
+        now_iso = now.isoformat()
+        now_epoch = now.timestamp()
+
+        # Terminations run concurrently after the status pass
+        to_terminate = []
+
+        ts_root = self.config["pod_timestamps"]
+
         for pod in pods:
-            namespace = pod['namespace']
-            name = pod['name']
-            full_name = pod['full_name']
+            namespace = pod.namespace
+            name = pod.name
+            full_name = pod.full_name
 
-            termination_window = self.config.get("default_termination_window", "2h")
-            should_terminate, remaining_hours = self.should_terminate_pod(namespace, name, termination_window)
+            ns_map = ts_root.get(namespace)
+            pod_info = ns_map.get(name) if ns_map else None
 
-            # Get pod age
-            pod_info = self.config["pod_timestamps"][namespace].get(name, {})
-            if "last_seen_running" in pod_info:
-                age_hours = self.calculate_pod_age(pod_info["last_seen_running"])
-                
+            should_terminate, remaining_hours, age_hours = self.should_terminate_pod(pod_info, limit_hours, now_epoch)
+
+            if age_hours is not None:
                 logger.info(f"\nPod Status: {name}")
                 logger.info(f"  Namespace: {namespace}")
                 logger.info(f"  Age: {self.format_duration(age_hours)}")
@@ -310,39 +466,73 @@ class K8sResourceManager:
 
             if should_terminate:
                 logger.info(f"\nPod {full_name} exceeded window of {termination_window}")
-                if self.terminate_pod(namespace, name, full_name):
-                    logger.info(f"Successfully terminated pod {full_name}")
-                else:
-                    logger.error(f"Failed to terminate pod {full_name}")
+                to_terminate.append(pod)
 
-    def run(self, interval: int = 3):  # Changed default interval to 3 seconds
-        """Main loop"""
-        logger.info("Starting Kubernetes Resource Manager")
-        logger.info(f"Excluded namespaces: {', '.join(self.config.get('excluded_namespaces', []))}")
+        if not to_terminate:
+            return
 
+        slots = asyncio.Semaphore(_MAX_CONCURRENT_TERMINATIONS)
+
+        async def terminate_limited(pod: PodRef) -> bool:
+            async with slots:
+                return await self.terminate_pod(pod.namespace, pod.name, pod.full_name, now_iso)
+
+        results = await asyncio.gather(*[terminate_limited(pod) for pod in to_terminate])
+        for pod, terminated in zip(to_terminate, results):
+            if terminated:
+                logger.info(f"Successfully terminated pod {pod.full_name}")
+            else:
+                logger.error(f"Failed to terminate pod {pod.full_name}")
+
+    def flush(self) -> None:
+        """Persist pending config changes and buffered log records"""
+        if self._dirty:
+            self.save_config()
+        log_file_handler.flush()
+
+    async def main_loop(self, interval: int) -> None:
+        """Check cycle loop"""
         while True:
             try:
                 logger.info("\nStarting new check cycle...")
 
-                # Reload config at start of each cycle
-                self.config = self.load_config()
+                # Reload config only if it changed on disk since last load/save
+                mtime = self.get_config_mtime()
+                if mtime is None or mtime != self._config_mtime:
+                    self.config = self.load_config()
+                    self._excluded_ns = set(self.config.get("excluded_namespaces", []))
+                    self._config_mtime = self.get_config_mtime()
 
-                pods = self.parse_gpushare_output()
+                pods, seen_pods = await self.parse_gpushare_output()
+                self.update_pod_timestamps(seen_pods)
                 if pods:
                     logger.info("Processing pods...")
-                    self.process_pods(pods)
+                    await self.process_pods(pods)
                 else:
                     logger.info("No pods found in non-excluded namespaces")
 
                 logger.info(f"Sleeping for {interval} seconds...")
-                time.sleep(interval)
 
-            except KeyboardInterrupt:
-                logger.info("Shutting down gracefully...")
-                break
+                # Write config and logs in a worker thread while sleeping
+                await asyncio.gather(
+                    asyncio.to_thread(self.flush),
+                    asyncio.sleep(interval)
+                )
+
             except Exception as e:
                 logger.error(f"Error in main loop: {str(e)}")
-                time.sleep(interval)
+                await asyncio.sleep(interval)
+
+    def run(self, interval: int = 3):  # Changed default interval to 3 seconds
+        """Main loop"""
+        logger.info("Starting Kubernetes Resource Manager")
+        logger.info(f"Excluded namespaces: {', '.join(self.config.get('excluded_namespaces', []))}")
+
+        try:
+            asyncio.run(self.main_loop(interval))
+        except KeyboardInterrupt:
+            logger.info("Shutting down gracefully...")
+            self.flush()
 
 if __name__ == "__main__":
     try: